@@ -3,73 +3,378 @@ import os
 import numpy as np
 import cv2
 import pandas as pd
-from tensorflow.keras.models import load_model
+from multiprocessing.connection import Listener, Client
+
+# Numba is optional; without it the batch conversion falls back to NumPy
+try:
+    import numba
+except ImportError:
+    numba = None
 
 # Frame size expected by the model
 size = 100
 
-# Load the pretrained model
-model = load_model('sample.keras')
+# Number of evenly spaced frames sampled from each clip
+frames_per_clip = 10
 
-# Usage: python Predictor.py <input_csv>
-if len(sys.argv) < 2:
-    print("Usage: python Predictor.py <input_csv>")
-    sys.exit(1)
+# Number of clips whose frames are stacked into a single model call
+clips_per_batch = 8
 
-csv_path = sys.argv[1]
+# Address of the persistent prediction server (python Predictor.py --serve)
+server_address = ('localhost', 6543)
 
-# Read the CSV containing clip metadata
-if not os.path.isfile(csv_path):
-    print(f"CSV file not found: {csv_path}")
-    sys.exit(1)
-df = pd.read_csv(csv_path)
+# Environment variable holding the server's authentication key (hex). Requests are
+# unpickled, so the key must be secret: generate one per launch, never hardcode it.
+server_authkey_env = 'STREETSMART_PREDICTOR_KEY'
 
-# Iterate over each clip row
-for idx, row in df.iterrows():
-    clip_file = row['clip_file']
-    print(f"Processing clip: {clip_file}...")
+def extract_clip_frames(clip_file, out):
+    """
+    Reads frames_per_clip evenly spaced frames from clip_file, converts them to
+    size x size grayscale and writes them into the uint8 array out
+    (shape (frames_per_clip, size, size)); see to_model_input for the model format.
+    Returns the number of frames written, or None if the clip could not be opened.
+    """
     if not os.path.isfile(clip_file):
         print(f"  Error: clip file not found: {clip_file}")
-        continue
+        return None
 
     cap = cv2.VideoCapture(clip_file)
     if not cap.isOpened():
         print(f"  Error opening video file: {clip_file}")
-        continue
+        return None
 
-    total_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-    pothole_detected = False
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    targets = sorted(set(int(i * total_frames / frames_per_clip) for i in range(frames_per_clip)))
+    count = 0
+    gray = None
 
-    # Extract 10 evenly spaced frames (in-memory, no files saved)
-    for i in range(10):
-        frame_idx = int(i * total_frames / 10)
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-        ret, frame = cap.read()
+    # Decode the clip once, front to back, keeping only the sampled frames.
+    # Seeking to each frame instead re-decodes from the previous keyframe every time.
+    # grab() skips the colour conversion for frames that are not kept.
+    frame_idx = 0
+    for target in targets:
+        while frame_idx < target and cap.grab():
+            frame_idx += 1
+        ret, frame = cap.read() if frame_idx == target else (False, None)
         if not ret:
-            print(f"  Warning: could not read frame {frame_idx}")
-            continue
-
-        # Preprocess for model
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        resized = cv2.resize(gray, (size, size))
-        x = resized.reshape(1, size, size, 1)
-
-        # Predict
-        predictions = model.predict(x)
-        predicted_class = np.argmax(predictions, axis=1)[0]
-        print(f"    Frame {i} -> class {predicted_class}")
-
-        # Class 1 indicates pothole
-        if predicted_class == 1:
-            pothole_detected = True
+            print(f"  Warning: could not read frame {target}")
             break
+        frame_idx += 1
+
+        # Preprocess for model, reusing the grayscale buffer across frames and
+        # resizing straight into the caller's batch slot.
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+        cv2.resize(gray, (size, size), dst=out[count])
+        count += 1
 
     cap.release()
+    return count
+
+def _to_model_input_numpy(frames, out):
+    np.copyto(out[..., 0], frames, casting='unsafe')
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _to_model_input_numba(frames, out):
+        # One fused loop per frame, spread over the batch
+        for i in numba.prange(frames.shape[0]):
+            for y in range(frames.shape[1]):
+                for x in range(frames.shape[2]):
+                    out[i, y, x, 0] = frames[i, y, x]
+
+def to_model_input(frames, out):
+    """
+    Converts a uint8 batch of frames (N, size, size) from extract_clip_frames into the
+    model's float32 input layout (N, size, size, 1), writing into out.
+    The model takes raw 0-255 pixel values, so no scaling is applied.
+    Uses a Numba-compiled loop when numba is installed.
+    """
+    if numba is not None:
+        _to_model_input_numba(frames, out)
+    else:
+        _to_model_input_numpy(frames, out)
+    return out
+
+def load_tflite_model(model_path):
+    """
+    Loads a TFLite flatbuffer (see convert_model.py) into an interpreter.
+    Returns an infer(batch) function mapping a float32 (N, size, size, 1) batch
+    to class probabilities; quantized inputs and outputs are converted using the
+    tensor's scale and zero point.
+    """
+    import tensorflow as tf
+
+    interp = tf.lite.Interpreter(model_path=model_path, num_threads=os.cpu_count())
+    input_details = interp.get_input_details()[0]
+    output_details = interp.get_output_details()[0]
+    in_scale, in_zero = input_details['quantization']
+    out_scale, out_zero = output_details['quantization']
+    batch_size = None
+
+    def infer(x):
+        nonlocal batch_size
+        # Only reallocate when the batch size changes (normally just the last batch)
+        if batch_size != len(x):
+            interp.resize_tensor_input(input_details['index'], [len(x), size, size, 1])
+            interp.allocate_tensors()
+            batch_size = len(x)
+        if input_details['dtype'] != np.float32:
+            limits = np.iinfo(input_details['dtype'])
+            x = np.clip(np.round(x / in_scale + in_zero), limits.min, limits.max)
+            x = x.astype(input_details['dtype'])
+        interp.set_tensor(input_details['index'], x)
+        interp.invoke()
+        preds = interp.get_tensor(output_details['index'])
+        if output_details['dtype'] != np.float32:
+            preds = (preds.astype(np.float32) - out_zero) * out_scale
+        return preds
+
+    return infer
+
+def load_tensorrt_model(model_path):
+    """
+    Deserializes a TensorRT engine (built from the ONNX export of convert_model.py
+    with trtexec) and returns an infer(batch) function.
+    The engine runs a fixed batch size (the exported batch, or the largest batch of
+    its optimization profile for dynamic-shape engines); host and device buffers and
+    the CUDA stream are allocated once, and larger batches are run in engine-sized chunks.
+    Uses the name-based tensor API (TensorRT 8.5 or newer, including 10.x).
+    Requires the optional tensorrt and pycuda packages and a CUDA GPU.
+    """
+    import tensorrt as trt
+    import pycuda.autoinit  # noqa: F401  (creates the CUDA context)
+    import pycuda.driver as cuda
+
+    logger = trt.Logger(trt.Logger.WARNING)
+    with open(model_path, 'rb') as f:
+        engine = trt.Runtime(logger).deserialize_cuda_engine(f.read())
+    context = engine.create_execution_context()
+
+    names = [engine.get_tensor_name(i) for i in range(engine.num_io_tensors)]
+    input_name = next(n for n in names if engine.get_tensor_mode(n) == trt.TensorIOMode.INPUT)
+    output_name = next(n for n in names if engine.get_tensor_mode(n) == trt.TensorIOMode.OUTPUT)
+
+    # Dynamic-batch engines report -1; run them at the profile's maximum shape
+    input_shape = tuple(engine.get_tensor_shape(input_name))
+    if min(input_shape) < 0:
+        input_shape = tuple(engine.get_tensor_profile_shape(input_name, 0)[2])
+    context.set_input_shape(input_name, input_shape)
+    output_shape = tuple(context.get_tensor_shape(output_name))
+
+    host_in = cuda.pagelocked_empty(input_shape, dtype=np.float32)
+    host_out = cuda.pagelocked_empty(output_shape, dtype=np.float32)
+    device_in = cuda.mem_alloc(host_in.nbytes)
+    device_out = cuda.mem_alloc(host_out.nbytes)
+    context.set_tensor_address(input_name, int(device_in))
+    context.set_tensor_address(output_name, int(device_out))
+    stream = cuda.Stream()
+    capacity = host_in.shape[0]
+
+    def infer(x):
+        preds = np.empty((len(x), host_out.shape[1]), dtype=np.float32)
+        for start in range(0, len(x), capacity):
+            chunk = x[start:start + capacity]
+            host_in[:len(chunk)] = chunk
+            host_in[len(chunk):] = 0
+            cuda.memcpy_htod_async(device_in, host_in, stream)
+            context.execute_async_v3(stream.handle)
+            cuda.memcpy_dtoh_async(host_out, device_out, stream)
+            stream.synchronize()
+            preds[start:start + len(chunk)] = host_out[:len(chunk)]
+        return preds
+
+    return infer
+
+def load_predictor(model_path):
+    """
+    Loads the model at model_path and returns an infer(batch) function.
+    .tflite files run on the TFLite interpreter, .trt engines on TensorRT,
+    anything else is loaded with Keras.
+    TensorFlow is only imported here, so clients of the prediction server do not load it.
+    """
+    if model_path.endswith('.tflite'):
+        return load_tflite_model(model_path)
+    if model_path.endswith('.trt'):
+        return load_tensorrt_model(model_path)
+
+    import tensorflow as tf
+    from tensorflow.keras.models import load_model
+
+    model = load_model(model_path)
+
+    # Traced once for the fixed frame shape and compiled with XLA, which fuses the
+    # conv/bias/activation ops and skips the Keras predict loop on every call.
+    run = tf.function(
+        lambda x: model(x, training=False),
+        input_signature=[tf.TensorSpec([None, size, size, 1], tf.float32)],
+        jit_compile=True,
+    )
+
+    # XLA compiles once per batch size, so every call uses one full predict_clips batch:
+    # partial batches are zero-padded and larger ones are run in chunks of that size.
+    batch = clips_per_batch * frames_per_clip
+    padded = np.zeros((batch, size, size, 1), dtype=np.float32)
+
+    def infer(x):
+        preds = []
+        for start in range(0, len(x), batch):
+            chunk = x[start:start + batch]
+            if len(chunk) < batch:
+                padded[:len(chunk)] = chunk
+                padded[len(chunk):] = 0
+                chunk = padded
+            preds.append(run(chunk).numpy()[:len(x) - start])
+        return np.concatenate(preds)
+
+    return infer
+
+def predict_clips(infer, clip_files, batch_clips=clips_per_batch):
+    """
+    Runs infer (see load_predictor) over frames sampled from each clip in clip_files.
+    Frames from up to batch_clips clips are stacked into one batch so the model
+    is dispatched once per batch rather than once per frame.
+    Returns a list with one entry per clip: True/False for the pothole result,
+    or None if the clip could not be read.
+    """
+    staged = np.empty((batch_clips * frames_per_clip, size, size), dtype=np.uint8)
+    frames = np.empty((batch_clips * frames_per_clip, size, size, 1), dtype=np.float32)
+    results = [None] * len(clip_files)
+
+    for start in range(0, len(clip_files), batch_clips):
+        # (clip_idx, first_row, n_frames) for every clip in this batch
+        index = []
+        filled = 0
+        for clip_idx in range(start, min(start + batch_clips, len(clip_files))):
+            clip_file = clip_files[clip_idx]
+            print(f"Processing clip: {clip_file}...")
+            count = extract_clip_frames(clip_file, staged[filled:filled + frames_per_clip])
+            if count is None:
+                continue
+            index.append((clip_idx, filled, count))
+            filled += count
+
+        # Predict all frames of the batch in one call
+        classes = np.empty(0, dtype=np.int64)
+        if filled:
+            to_model_input(staged[:filled], frames[:filled])
+            preds = infer(frames[:filled])
+            classes = preds.argmax(axis=1)
+
+        for clip_idx, first_row, count in index:
+            clip_classes = classes[first_row:first_row + count]
+            for i, predicted_class in enumerate(clip_classes):
+                print(f"    Frame {i} -> class {predicted_class}")
+
+            # Class 1 indicates pothole
+            pothole_detected = bool((clip_classes == 1).any())
+            results[clip_idx] = pothole_detected
+            print(f"  {clip_files[clip_idx]}: pothole detected: {pothole_detected}\n")
+
+    return results
+
+def read_clips(path):
+    """
+    Reads the clip metadata table written by video_processor.py.
+    Parquet is the primary format; older .csv files are still accepted.
+    """
+    if path.endswith('.csv'):
+        return pd.read_csv(path)
+    return pd.read_parquet(path)
+
+def write_clips(df, path):
+    """
+    Writes the clip metadata table back to path, in the format given by its extension.
+    """
+    if path.endswith('.csv'):
+        df.to_csv(path, index=False)
+    else:
+        df.to_parquet(path, engine='pyarrow', index=False)
+
+def apply_results(df, results):
+    """
+    Stores the predict_clips results in the DataFrame's pothole column.
+    Clips that could not be read (None) keep their previous result.
+    """
+    if 'pothole' in df.columns:
+        pothole = df['pothole'].fillna(False).to_numpy(dtype=bool, copy=True)
+    else:
+        pothole = np.zeros(len(df), dtype=bool)
+    for i, pothole_detected in enumerate(results):
+        if pothole_detected is not None:
+            pothole[i] = pothole_detected
+
+    # Update the DataFrame in one shot
+    df['pothole'] = pothole
+    return df
+
+def serve(model_path='sample.keras', address=server_address):
+    """
+    Runs a long-lived prediction server so the model is loaded only once.
+    Each connection sends a request {'clips': [clip_file, ...]} and receives the
+    predict_clips result for those clips.
+    Clients must authenticate with the key from the server_authkey_env environment
+    variable; if it is unset a random key is generated and printed.
+    """
+    if server_authkey_env in os.environ:
+        authkey = bytes.fromhex(os.environ[server_authkey_env])
+    else:
+        authkey = os.urandom(32)
+        print(f"{server_authkey_env}={authkey.hex()}")
+
+    # Bind before loading the model, so a port that is already taken fails immediately
+    with Listener(address, authkey=authkey) as listener:
+        infer = load_predictor(model_path)
+        print(f"Prediction server listening on {address[0]}:{address[1]}")
+        while True:
+            try:
+                # accept() performs the authentication handshake, which fails for
+                # clients with the wrong key or that disconnect early.
+                with listener.accept() as conn:
+                    request = conn.recv()
+                    conn.send(predict_clips(infer, request['clips']))
+            except Exception as e:
+                print(f"Error handling prediction request: {e}")
+
+def request_predictions(clip_files, authkey, address=server_address):
+    """
+    Sends clip_files to a running prediction server and returns its results.
+    Raises ConnectionRefusedError if no server is listening, and
+    multiprocessing.AuthenticationError if the server uses a different key.
+    """
+    with Client(address, authkey=authkey) as conn:
+        conn.send({'clips': list(clip_files)})
+        return conn.recv()
+
+def main():
+    # Usage: python Predictor.py <clips_file> [model_file]
+    #        python Predictor.py --serve [model_file]
+    if len(sys.argv) < 2:
+        print("Usage: python Predictor.py <clips_file> [model_file]")
+        print("       python Predictor.py --serve [model_file]")
+        sys.exit(1)
+
+    model_path = sys.argv[2] if len(sys.argv) > 2 else 'sample.keras'
+    if sys.argv[1] == '--serve':
+        serve(model_path)
+        return
+
+    clips_path = sys.argv[1]
+
+    # Read the table containing clip metadata
+    if not os.path.isfile(clips_path):
+        print(f"Clips file not found: {clips_path}")
+        sys.exit(1)
+    df = read_clips(clips_path)
+
+    # Load the pretrained model
+    infer = load_predictor(model_path)
+
+    results = predict_clips(infer, df['clip_file'].tolist())
+    apply_results(df, results)
 
-    # Update the DataFrame
-    df.at[idx, 'pothole'] = pothole_detected
-    print(f"  Pothole detected: {pothole_detected}\n")
+    # Write updates back to the same file (in-place)
+    write_clips(df, clips_path)
+    print(f"Clips file updated: {clips_path}")
 
-# Write updates back to the same CSV (in-place)
-df.to_csv(csv_path, index=False)
-print(f"CSV updated: {csv_path}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import sys
+import os
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import load_model
+from Predictor import size, frames_per_clip, clips_per_batch, extract_clip_frames, to_model_input, read_clips
+
+# Maximum number of clips sampled for INT8 calibration
+calibration_clips = 20
+
+def calibration_frames(clips_path):
+    """
+    Samples preprocessed frames from the clips listed in clips_path, exactly as
+    Predictor.py feeds them to the model. Returns a float32 array of shape
+    (N, size, size, 1), which is empty if no clip could be read.
+    """
+    df = read_clips(clips_path)
+    staged = np.empty((calibration_clips * frames_per_clip, size, size), dtype=np.uint8)
+    filled = 0
+    for clip_file in df['clip_file'].head(calibration_clips):
+        count = extract_clip_frames(clip_file, staged[filled:filled + frames_per_clip])
+        filled += count or 0
+    frames = np.empty((filled, size, size, 1), dtype=np.float32)
+    return to_model_input(staged[:filled], frames)
+
+def export_onnx(model_path, output_path):
+    """
+    Exports the Keras model at model_path to ONNX (opset 13) at output_path.
+    The input tensor, named 'input', has a fixed batch of clips_per_batch * frames_per_clip
+    frames (one full Predictor.py batch), so TensorRT builds a static-shape engine.
+    Requires the optional tf2onnx package.
+    """
+    import tf2onnx
+
+    model = load_model(model_path)
+    run = tf.function(lambda x: model(x, training=False))
+    batch = clips_per_batch * frames_per_clip
+    spec = [tf.TensorSpec([batch, size, size, 1], tf.float32, name='input')]
+    tf2onnx.convert.from_function(run, input_signature=spec, opset=13, output_path=output_path)
+    print(f"ONNX model written: {output_path}")
+
+def convert(model_path, output_path, clips_path=None):
+    """
+    Converts the Keras model at model_path to a TFLite flatbuffer at output_path.
+    With calibration frames from clips_path the weights and activations are
+    quantized to INT8; otherwise the weights are stored as FP16.
+    """
+    model = load_model(model_path)
+    run = tf.function(
+        lambda x: model(x, training=False),
+        input_signature=[tf.TensorSpec([None, size, size, 1], tf.float32)],
+    )
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([run.get_concrete_function()], model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    frames = calibration_frames(clips_path) if clips_path else np.empty((0, size, size, 1), np.float32)
+    if len(frames):
+        print(f"Calibrating INT8 quantization on {len(frames)} frames...")
+        converter.representative_dataset = lambda: ([frame[None]] for frame in frames)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    else:
+        print("No calibration frames available, converting with FP16 weights...")
+        converter.target_spec.supported_types = [tf.float16]
+
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+    print(f"TFLite model written: {output_path}")
+
+if __name__ == "__main__":
+    # Usage: python convert_model.py [clips_file]
+    # Writes sample.tflite next to sample.keras; run it with
+    #   python Predictor.py <clips_file> sample.tflite
+    #
+    # Usage: python convert_model.py --onnx
+    # Writes sample.onnx with a fixed batch of Predictor.clips_per_batch * frames_per_clip
+    # frames; build the TensorRT engine with
+    #   trtexec --onnx=sample.onnx --saveEngine=sample.trt --fp16
+    # and run it with
+    #   python Predictor.py <clips_file> sample.trt
+    if len(sys.argv) > 1 and sys.argv[1] == '--onnx':
+        export_onnx('sample.keras', 'sample.onnx')
+        sys.exit(0)
+
+    clips_path = sys.argv[1] if len(sys.argv) > 1 else None
+    if clips_path and not os.path.isfile(clips_path):
+        print(f"Clips file not found: {clips_path}")
+        sys.exit(1)
+    convert('sample.keras', 'sample.tflite', clips_path)
@@ -4,39 +4,149 @@ import pandas as pd
 import subprocess
 import folium
 import datetime
-import base64
+import ast
+import re
+import time
+import atexit
+from multiprocessing import AuthenticationError
 from streamlit_folium import st_folium
+from Predictor import (read_clips, write_clips, apply_results, request_predictions,
+                       server_address, server_authkey_env)
+
+# datetime.datetime(2025, 3, 31, 23, 0, 35) as written by older CSV exports
+_DATETIME_RE = re.compile(r"datetime\.datetime\(([^()]*)\)")
 
 def parse_gps_data(gps_str):
     """
-    Safely evaluate the gps_data string.
-    Uses eval with a restricted globals dictionary to allow datetime.datetime calls.
+    Safely parse the gps_data string of older CSV exports.
+    The datetime.datetime(...) calls are rewritten to plain tuples so the string can be
+    read with ast.literal_eval (no code is executed), then turned back into datetimes.
     """
     try:
-        # Allow only the datetime module to resolve datetime.datetime(...)
-        gps_points = eval(gps_str, {"datetime": datetime})
+        gps_points = ast.literal_eval(_DATETIME_RE.sub(r"(\1)", gps_str))
+        for point in gps_points:
+            for key, value in point.items():
+                if isinstance(value, tuple):
+                    point[key] = datetime.datetime(*value)
         return gps_points
     except Exception as e:
         st.warning(f"Failed to parse gps_data: {e}")
         return []
 
-def get_video_data_url(clip_file):
+@st.cache_data(max_entries=1)
+def load_clips(path, mtime):
+    """
+    Load the clip metadata table, cached until the file changes (mtime is part of the key).
+    Parquet files keep gps_data as a list of records. Older CSV files store it as a
+    string, which is parsed once here rather than on every access.
+    """
+    if path.endswith(".csv"):
+        df = pd.read_csv(path)
+        df["gps_data"] = df["gps_data"].map(parse_gps_data)
+        return df
+    return pd.read_parquet(path)
+
+def show_clip(clip_file):
     """
-    Read the video file, encode it as base64, and return a data URL.
-    This enables embedding the video in the HTML popup.
+    Play the given clip below the map.
+    Streamlit serves the bytes through its media endpoint, so only the selected clip
+    is loaded instead of embedding every clip into the map HTML.
     """
     if os.path.exists(clip_file):
-        try:
-            with open(clip_file, "rb") as f:
-                video_bytes = f.read()
-            video_base64 = base64.b64encode(video_bytes).decode("utf-8")
-            return f"data:video/mp4;base64,{video_base64}"
-        except Exception as e:
-            st.warning(f"Failed to load video file {clip_file}: {e}")
-            return None
+        st.video(clip_file, format="video/mp4")
     else:
         st.warning(f"Video file {clip_file} does not exist.")
-        return None
+
+@st.cache_resource
+def start_prediction_server():
+    """
+    Start the prediction server (Predictor.py --serve) once per Streamlit process.
+    The model then stays loaded across reruns and repeated detection runs.
+    A fresh authentication key is generated for every launch and handed to the
+    server through its environment. The server is terminated when Streamlit exits.
+    Returns the server process and its key.
+    """
+    authkey = os.urandom(32)
+    env = dict(os.environ, **{server_authkey_env: authkey.hex()})
+    server = subprocess.Popen(["python", "Predictor.py", "--serve"], env=env)
+    atexit.register(server.terminate)
+    return server, authkey
+
+def detect_potholes(clips_path, timeout=120):
+    """
+    Send every clip in clips_path to the prediction server and store the results.
+    Waits up to timeout seconds for a freshly started server to accept connections.
+    """
+    server, authkey = start_prediction_server()
+    df = read_clips(clips_path)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            results = request_predictions(df["clip_file"].tolist(), authkey)
+            break
+        except (ConnectionRefusedError, AuthenticationError):
+            # A server that exited could not bind the port (e.g. a stale server from
+            # an earlier run still holds it, which also rejects our key).
+            if server.poll() is not None:
+                # Let the next attempt start a fresh server
+                start_prediction_server.clear()
+                raise RuntimeError(
+                    f"prediction server exited with status {server.returncode}; "
+                    f"is port {server_address[1]} used by another process?"
+                )
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+    write_clips(apply_results(df, results), clips_path)
+
+@st.cache_resource(max_entries=1)
+def build_map(clips_path, mtime):
+    """
+    Build the Folium map with one marker per clip.
+    Cached on the clips file's path and mtime, so the markers are only rebuilt when
+    the file changes rather than on every rerun.
+    """
+    df = load_clips(clips_path, mtime)
+
+    # Determine default map center using the first valid GPS point
+    default_lat, default_lon = 41.77, -88.12  # fallback coordinates
+    clip_col = df.columns.get_loc("clip_file")
+    gps_col = df.columns.get_loc("gps_data")
+    pothole_col = df.columns.get_loc("pothole")
+    for t in df.itertuples(index=False, name=None):
+        gps_points = t[gps_col]
+        if len(gps_points) and "latitude" in gps_points[0]:
+            default_lat = gps_points[0]["latitude"]
+            default_lon = gps_points[0]["longitude"]
+            break
+
+    folium_map = folium.Map(location=[default_lat, default_lon], zoom_start=13)
+
+    # Add one marker per video (using only the first GPS coordinate)
+    for t in df.itertuples(index=False, name=None):
+        clip_file = t[clip_col]
+        gps_points = t[gps_col]
+        if not len(gps_points):
+            continue
+
+        first_point = gps_points[0]
+        lat = first_point.get("latitude")
+        lon = first_point.get("longitude")
+        if lat is None or lon is None:
+            continue
+
+        # The clip itself is played below the map when its marker is clicked
+        popup_html = f"<p><strong>Clip:</strong> {clip_file}</p>"
+        popup = folium.Popup(popup_html, max_width=400)
+        pin_color = "red" if t[pothole_col] else "blue"
+        folium.Marker(
+            location=[lat, lon],
+            popup=popup,
+            tooltip=clip_file,
+            icon=folium.Icon(color=pin_color, icon="film", prefix="fa")
+        ).add_to(folium_map)
+
+    return folium_map
 
 def main():
     st.title("Video Map Generator")
@@ -60,67 +170,47 @@ def main():
         try:
             # Run the external video processing script.
             subprocess.run(["python", "video_processor.py"], check=True)
-            st.success("Video processing completed. clips_data.csv generated.")
+            st.success("Video processing completed. clips_data.parquet generated.")
         except Exception as e:
             st.error(f"An error occurred while processing videos: {e}")
 
-    st.header("3. Map with Video Clips")
-    if os.path.exists("clips_data.csv"):
-        df = pd.read_csv("clips_data.csv")
-        st.write("Preview of clips_data.csv:")
+    # Fall back to the CSV written by older versions of video_processor.py
+    clips_path = "clips_data.parquet"
+    if not os.path.exists(clips_path):
+        clips_path = "clips_data.csv"
+
+    st.header("3. Detect Potholes")
+    if st.button("Detect Potholes"):
+        if not os.path.exists(clips_path):
+            st.error("clips_data.parquet not found. Please process videos first.")
+        else:
+            try:
+                with st.spinner("Running pothole detection..."):
+                    detect_potholes(clips_path)
+                st.success(f"Pothole detection completed. {clips_path} updated.")
+            except Exception as e:
+                st.error(f"An error occurred while detecting potholes: {e}")
+
+    st.header("4. Map with Video Clips")
+    if os.path.exists(clips_path):
+        mtime = os.path.getmtime(clips_path)
+        df = load_clips(clips_path, mtime)
+        st.write(f"Preview of {clips_path}:")
         st.dataframe(df)
 
-        # Determine default map center using the first valid GPS point
-        default_lat, default_lon = 41.77, -88.12  # fallback coordinates
-        for _, row in df.iterrows():
-            gps_points = parse_gps_data(row["gps_data"])
-            if gps_points and isinstance(gps_points, list) and "latitude" in gps_points[0]:
-                default_lat = gps_points[0]["latitude"]
-                default_lon = gps_points[0]["longitude"]
-                break
-
-        folium_map = folium.Map(location=[default_lat, default_lon], zoom_start=13)
-
-        # Add one marker per video (using only the first GPS coordinate)
-        for index, row in df.iterrows():
-            clip_file = row["clip_file"]
-            gps_points = parse_gps_data(row["gps_data"])
-            if not gps_points or not isinstance(gps_points, list):
-                continue
-
-            first_point = gps_points[0]
-            lat = first_point.get("latitude")
-            lon = first_point.get("longitude")
-            if lat is None or lon is None:
-                continue
-
-            # Encode the video file as a base64 data URL
-            video_data_url = get_video_data_url(clip_file)
-            if video_data_url:
-                popup_html = f"""
-                <div style="width: 340px">
-                  <p><strong>Clip:</strong> {clip_file}</p>
-                  <video width="320" height="240" controls>
-                    <source src="{video_data_url}" type="video/mp4">
-                    Your browser does not support the video tag.
-                  </video>
-                </div>
-                """
-            else:
-                popup_html = f"<p>Clip file {clip_file} not found.</p>"
-
-            popup = folium.Popup(popup_html, max_width=400)
-            pin_color = "red" if row["pothole"] else "blue"
-            folium.Marker(
-                location=[lat, lon],
-                popup=popup,
-                icon=folium.Icon(color=pin_color, icon="film", prefix="fa")
-            ).add_to(folium_map)
+        folium_map = build_map(clips_path, mtime)
 
         st.subheader("Map View")
-        st_folium(folium_map, width=700, height=500)
+        map_state = st_folium(folium_map, width=700, height=500,
+                              returned_objects=["last_object_clicked_tooltip"])
+
+        # Markers carry their clip path as the tooltip; only play clips from the table
+        selected_clip = (map_state or {}).get("last_object_clicked_tooltip")
+        if selected_clip and selected_clip in set(df["clip_file"]):
+            st.subheader("Selected Clip")
+            show_clip(selected_clip)
     else:
-        st.info("clips_data.csv not found. Please upload videos and click 'Process Videos' first.")
+        st.info("clips_data.parquet not found. Please upload videos and click 'Process Videos' first.")
 
 if __name__ == "__main__":
     main()
@@ -2,56 +2,69 @@ import os
 import subprocess
 import json
 import re
+import csv
+import functools
+import concurrent.futures
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
+
+# Use the linear-time RE2 engine when google-re2 is installed; fall back to re.
+try:
+    import re2 as regex_engine
+except ImportError:
+    regex_engine = re
+
+# GPS record: timestamp with 'Z', then latitude then longitude (allowing for spaces).
+# Compiled once so the cost is paid a single time for the whole folder. The pattern is
+# bytes so ExifTool's output can be scanned without decoding it first.
+_GPS_RE = regex_engine.compile(
+    rb'(\d{4}:\d{2}:\d{2} \d{2}:\d{2}:\d{2}Z)\s*([+-]?\d+\.\d+)\s*([+-]\d+\.\d+)'
+)
+
+# Bytes kept between streamed chunks so records straddling a boundary are matched.
+# Must be longer than any single GPS record.
+_GPS_TAIL = 256
 
 def segment_video_single(input_file, output_dir, segment_length=10):
     """
     Uses FFmpeg to segment a single video file into clips of segment_length seconds.
     Output files are named as <basename>_clip_%03d.mp4 in output_dir.
-    Returns the list of output clip filenames (full paths).
+    Returns a list of (clip filename (full path), duration in seconds) tuples, in order,
+    read from the CSV segment list FFmpeg writes for this run. The durations come from
+    each segment's recorded start and end times, so no FFprobe call is needed.
     """
     base_name = os.path.splitext(os.path.basename(input_file))[0]
     output_pattern = os.path.join(output_dir, f"{base_name}_clip_%03d.mp4")
+    segment_list = os.path.join(output_dir, f"{base_name}_segments.csv")
     ffmpeg_cmd = [
         "ffmpeg",
+        "-loglevel", "error",
         "-i", input_file,
         "-c", "copy",
         "-map_metadata", "0",
+        "-avoid_negative_ts", "make_zero",
         "-f", "segment",
         "-segment_time", str(segment_length),
+        # Accept a keyframe slightly before the boundary as the cut point, so stream-copied
+        # clips overshoot segment_length less often and more of them pass the duration
+        # filter in process_single_file (durations come from the segment list below).
+        "-segment_time_delta", "0.05",
+        "-segment_list", segment_list,
+        "-segment_list_type", "csv",
         "-reset_timestamps", "1",
         output_pattern
     ]
     print(f"Segmenting {input_file} into 10-second clips...")
     subprocess.run(ffmpeg_cmd, check=True)
-    
-    # Gather generated clips for this file.
-    clips = [os.path.join(output_dir, f)
-             for f in os.listdir(output_dir)
-             if f.startswith(base_name + "_clip_") and f.endswith(".mp4")]
-    clips.sort()  # Ensure ordering.
-    return clips
 
-def get_clip_duration(clip_file):
-    """
-    Uses FFprobe to determine the duration (in seconds) of a video clip.
-    """
-    ffprobe_cmd = [
-        "ffprobe",
-        "-v", "error",
-        "-select_streams", "v:0",
-        "-show_entries", "format=duration",
-        "-of", "default=noprint_wrappers=1:nokey=1",
-        clip_file
-    ]
-    try:
-        output = subprocess.check_output(ffprobe_cmd).decode().strip()
-        duration = float(output)
-    except Exception as e:
-        print(f"Error getting duration for {clip_file}: {e}")
-        duration = 0.0
-    return duration
+    # Gather the clips produced by this run from the segment list.
+    # Each row is: filename, segment start time, segment end time.
+    with open(segment_list, newline="") as f:
+        clips = [(os.path.join(output_dir, os.path.basename(name)), float(end) - float(start))
+                 for name, start, end in csv.reader(f)]
+    os.remove(segment_list)
+    return clips
 
 def extract_clip_metadata(clip_file):
     """
@@ -74,66 +87,78 @@ def extract_clip_metadata(clip_file):
         metadata = {}
     return metadata
 
-def extract_raw_gps_data(input_file):
+def extract_raw_gps_data(input_file, chunk_size=1 << 20):
     """
-    Uses ExifTool to extract the raw metadata string (including embedded mov_text stream data)
+    Uses ExifTool to extract the raw metadata (including embedded mov_text stream data)
     from the input file.
+    The output is streamed: raw bytes chunks of up to chunk_size bytes are yielded while
+    ExifTool is still running, instead of buffering the whole dump in memory.
     """
     cmd = ["exiftool", "-ee", "-b", input_file]
     try:
-        output = subprocess.check_output(cmd).decode('utf-8', errors='ignore')
-        return output
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=chunk_size) as proc:
+            yield from iter(lambda: proc.stdout.read(chunk_size), b"")
+        if proc.returncode:
+            print(f"Error extracting raw GPS data: exiftool exited with status {proc.returncode}")
     except Exception as e:
         print("Error extracting raw GPS data:", e)
-        return ""
 
-def parse_gps_data(raw_string):
+def parse_gps_data(raw_data):
     """
-    Parses the raw GPS metadata string to extract records.
+    Parses the raw GPS metadata to extract records.
+    raw_data is either bytes or an iterable of bytes chunks (as yielded by
+    extract_raw_gps_data); chunks are matched as they arrive.
     Each valid record is expected to match the following pattern:
       YYYY:MM:DD HH:MM:SSZ<latitude><longitude>
     For example:
       2025:03:31 23:00:35Z41.7698047868907-88.120337175205329
-    Returns a list of dictionaries with keys: timestamp, latitude, longitude.
-    """
-    gps_records = []
-    # Regex pattern: timestamp with 'Z', then latitude then longitude (allowing for spaces).
-    pattern = re.compile(
-        r'(\d{4}:\d{2}:\d{2} \d{2}:\d{2}:\d{2}Z)\s*([+-]?\d+\.\d+)\s*([+-]\d+\.\d+)'
-    )
-    matches = pattern.findall(raw_string)
-    for ts_str, lat_str, lon_str in matches:
-        try:
-            dt = datetime.strptime(ts_str, "%Y:%m:%d %H:%M:%SZ")
-            lat = float(lat_str)
-            lon = float(lon_str)
-            gps_records.append({
-                "timestamp": dt,
-                "latitude": lat,
-                "longitude": lon
-            })
-        except Exception as e:
-            print("Error processing GPS record:", (ts_str, lat_str, lon_str), e)
-    gps_records.sort(key=lambda x: x["timestamp"])
-    return gps_records
+    Returns a DataFrame with columns timestamp, latitude, longitude, sorted by timestamp.
+    """
+    if isinstance(raw_data, bytes):
+        raw_data = [raw_data]
+
+    matches = []
+    tail = b""
+    for chunk in raw_data:
+        buf = tail + chunk
+        # Only accept matches that end well before the end of the buffer; a record
+        # near the end may continue in the next chunk and is kept in the tail instead.
+        cut = len(buf) - _GPS_TAIL
+        keep_from = max(cut, 0)
+        for m in _GPS_RE.finditer(buf):
+            if m.end() > cut:
+                keep_from = m.start()
+                break
+            matches.append(m.groups())
+            keep_from = max(m.end(), cut)
+        tail = buf[keep_from:]
+    matches.extend(_GPS_RE.findall(tail))
+
+    # Convert all records at once rather than one strptime/float call per record
+    fields = np.array(matches, dtype=bytes).reshape(-1, 3)
+    gps_records = pd.DataFrame({
+        "timestamp": pd.to_datetime(fields[:, 0].astype(str), format="%Y:%m:%d %H:%M:%SZ",
+                                    errors="coerce"),
+        "latitude": fields[:, 1].astype(np.float64),
+        "longitude": fields[:, 2].astype(np.float64),
+    })
+    invalid = gps_records["timestamp"].isna()
+    for ts_str, lat_str, lon_str in fields[invalid.to_numpy()].tolist():
+        print("Error processing GPS record:", (ts_str, lat_str, lon_str), "invalid timestamp")
+    gps_records = gps_records[~invalid].sort_values("timestamp", kind="stable")
+    return gps_records.reset_index(drop=True)
 
 def get_video_start_time(input_file):
     """
-    Uses FFprobe to extract the video's start time from available tags.
+    Uses a single FFprobe call (see extract_clip_metadata) to extract the video's
+    start time from the available format tags.
     Tries 'encoded_date' first, then 'creation_time'.
     Returns a datetime object, or None if extraction fails.
     """
+    tags = extract_clip_metadata(input_file).get("format", {}).get("tags", {})
     for tag in ["encoded_date", "creation_time"]:
-        cmd = [
-            "ffprobe",
-            "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", f"format_tags={tag}",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            input_file
-        ]
         try:
-            output = subprocess.check_output(cmd).decode().strip()
+            output = tags.get(tag, "").strip()
             if output:
                 output = output.replace("UTC", "").strip()
                 dt = datetime.strptime(output, "%Y-%m-%d %H:%M:%S")
@@ -148,12 +173,23 @@ def associate_gps_with_clips(clips_info, gps_records, video_start, segment_lengt
     Each clip covers the interval:
       video_start + i*segment_length  to video_start + (i+1)*segment_length
     Adds a 'gps_data' key (a list of GPS records) to each clip's dictionary.
+    gps_records is the DataFrame returned by parse_gps_data (sorted by timestamp), so the
+    clip boundaries are located with a single binary search.
     """
+    timestamps = gps_records["timestamp"].to_numpy(dtype="datetime64[us]")
+    edges = (np.datetime64(video_start, "us")
+             + np.arange(len(clips_info) + 1) * np.timedelta64(round(segment_length * 1e6), "us"))
+    bounds = np.searchsorted(timestamps, edges, side="left")
+
+    # Plain dicts with datetime timestamps, as stored in the clips table
+    records = [
+        {"timestamp": ts, "latitude": lat, "longitude": lon}
+        for ts, lat, lon in zip(timestamps.tolist(),
+                                gps_records["latitude"].tolist(),
+                                gps_records["longitude"].tolist())
+    ]
     for i, clip in enumerate(clips_info):
-        clip_start = video_start + timedelta(seconds=i * segment_length)
-        clip_end = video_start + timedelta(seconds=(i + 1) * segment_length)
-        clip_gps = [rec for rec in gps_records if clip_start <= rec["timestamp"] < clip_end]
-        clip["gps_data"] = clip_gps
+        clip["gps_data"] = records[bounds[i]:bounds[i + 1]]
     return clips_info
 
 def process_single_file(input_file, output_dir, segment_length=10):
@@ -168,7 +204,7 @@ def process_single_file(input_file, output_dir, segment_length=10):
     """
     base_name = os.path.splitext(os.path.basename(input_file))[0]
     # Segment the video into clips.
-    clip_files = segment_video_single(input_file, output_dir, segment_length)
+    segments = segment_video_single(input_file, output_dir, segment_length)
     
     # Extract and parse GPS data.
     raw_gps_data = extract_raw_gps_data(input_file)
@@ -177,15 +213,14 @@ def process_single_file(input_file, output_dir, segment_length=10):
     
     # Determine the video's start time.
     video_start = get_video_start_time(input_file)
-    if video_start is None and gps_records:
-        video_start = gps_records[0]["timestamp"]
+    if video_start is None and len(gps_records):
+        video_start = gps_records["timestamp"].iloc[0].to_pydatetime()
     if video_start is None:
         raise ValueError(f"Unable to determine the start time for {input_file}.")
     print(f"File {input_file}: Video start time: {video_start}")
     
     file_clips = []
-    for idx, clip_file in enumerate(clip_files):
-        duration = get_clip_duration(clip_file)
+    for idx, (clip_file, duration) in enumerate(segments):
         if abs(duration - segment_length) < 0.1:
             #metadata = extract_clip_metadata(clip_file)
             clip_data = {
@@ -206,21 +241,40 @@ def process_single_file(input_file, output_dir, segment_length=10):
     file_clips = associate_gps_with_clips(file_clips, gps_records, video_start, segment_length)
     return file_clips
 
-def process_folder(input_folder, output_dir, segment_length=10):
+def process_single_file_safe(input_file, output_dir, segment_length=10):
+    """
+    Wrapper around process_single_file for use in a worker process.
+    Errors are reported and an empty list is returned, so one bad file does not
+    abort the rest of the folder.
+    """
+    print(f"Processing file: {input_file}")
+    try:
+        return process_single_file(input_file, output_dir, segment_length)
+    except Exception as e:
+        print(f"Error processing {input_file}: {e}")
+        return []
+
+def process_folder(input_folder, output_dir, segment_length=10, max_workers=None):
     """
     Processes all MP4 files in input_folder, segments each file,
     and returns a combined list of clip information. All output clips are saved in output_dir.
+    Files are independent, so they are processed in parallel by max_workers processes
+    (default: half the CPU cores, since FFmpeg runs its own threads).
+    Clips are returned in the same file order as a sequential run.
     """
+    input_files = [os.path.join(input_folder, file)
+                   for file in os.listdir(input_folder)
+                   if file.lower().endswith(".mp4")]
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 1) // 2)
+
+    worker = functools.partial(process_single_file_safe,
+                               output_dir=output_dir,
+                               segment_length=segment_length)
     all_clips = []
-    for file in os.listdir(input_folder):
-        if file.lower().endswith(".mp4"):
-            input_file = os.path.join(input_folder, file)
-            print(f"Processing file: {input_file}")
-            try:
-                file_clips = process_single_file(input_file, output_dir, segment_length)
-                all_clips.extend(file_clips)
-            except Exception as e:
-                print(f"Error processing {input_file}: {e}")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for file_clips in executor.map(worker, input_files):
+            all_clips.extend(file_clips)
     return all_clips
 
 if __name__ == "__main__":
@@ -244,4 +298,5 @@ if __name__ == "__main__":
     # Optionally, if using ace_tools:
     # ace_tools.display_dataframe_to_user("Clips Data", df)
 
-    df.to_csv("clips_data.csv", index=False)
+    # Parquet keeps gps_data as a list-of-structs column instead of a stringified repr.
+    df.to_parquet("clips_data.parquet", engine="pyarrow", index=False)